@@ -1,13 +1,20 @@
 import os
 import sqlite3
 import json
+import zlib
+import html
+import hmac
+import gzip
+import shutil
+import heapq
+import time
 from dotenv import load_dotenv
 import telebot
 from telebot import types
-from typing import Optional, List, Any, Dict
+from typing import Optional, List, Any, Dict, Tuple
 from datetime import datetime
-from flask import Flask
-from threading import Thread
+from flask import Flask, request, jsonify, Response, g
+from threading import Thread, Lock, Condition
 
 # =====================
 # Загрузка переменных окружения
@@ -54,7 +61,8 @@ def init_db():
         proofs TEXT,
         status TEXT DEFAULT 'open',
         admin_id INTEGER, 
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        offered_admin_id INTEGER
     )
     """)
 
@@ -68,7 +76,9 @@ def init_db():
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
         tg_id INTEGER PRIMARY KEY,
-        username TEXT
+        username TEXT,
+        is_active INTEGER DEFAULT 1,
+        last_failure_at DATETIME
     )
     """)
     cur.execute("""
@@ -86,6 +96,62 @@ def init_db():
         cur.execute("ALTER TABLE tickets ADD COLUMN admin_id INTEGER")
         print(">>> [MIGRATION] Столбец 'admin_id' успешно добавлен.")
 
+    # МИГРАЦИЯ: кому предложен тикет при автоназначении (для восстановления таймера после перезапуска)
+    try:
+        cur.execute("SELECT offered_admin_id FROM tickets LIMIT 1")
+    except sqlite3.OperationalError:
+        print(">>> [MIGRATION] Добавляем столбец 'offered_admin_id' в tickets...")
+        cur.execute("ALTER TABLE tickets ADD COLUMN offered_admin_id INTEGER")
+
+    # МИГРАЦИЯ: флаг доступности пользователя (заблокировал бота / удалил аккаунт)
+    try:
+        cur.execute("SELECT is_active, last_failure_at FROM users LIMIT 1")
+    except sqlite3.OperationalError:
+        print(">>> [MIGRATION] Добавляем столбцы 'is_active' и 'last_failure_at' в users...")
+        cur.execute("ALTER TABLE users ADD COLUMN is_active INTEGER DEFAULT 1")
+        cur.execute("ALTER TABLE users ADD COLUMN last_failure_at DATETIME")
+    # Индекс для выборки только доступных чатов (рассылки, уведомления, чаты)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active, tg_id)")
+
+    # Журнал переписки админ/игрок и сжатые архивы старых сообщений
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chat_transcripts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        admin_id INTEGER,
+        direction TEXT,
+        content_type TEXT,
+        text TEXT,
+        file_id TEXT,
+        created_at DATETIME
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transcripts_user ON chat_transcripts(user_id, id)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chat_transcript_archive (
+        user_id INTEGER,
+        first_id INTEGER,
+        last_id INTEGER,
+        messages INTEGER,
+        data BLOB,
+        PRIMARY KEY (user_id, first_id)
+    )
+    """)
+
+    # Окно обработанных update_id (одна строка: максимальный id + битовая маска)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        high INTEGER,
+        bitmap BLOB,
+        checkpointed_at REAL
+    )
+    """)
+    try:
+        cur.execute("SELECT checkpointed_at FROM processed_updates LIMIT 1")
+    except sqlite3.OperationalError:
+        cur.execute("ALTER TABLE processed_updates ADD COLUMN checkpointed_at REAL")
+
     conn.commit()
     print(">>> Инициализация завершена.")
 
@@ -94,6 +160,77 @@ init_db()
 cur.execute("INSERT OR IGNORE INTO admins(tg_id, level) VALUES(?,?)", (OWNER_ID, 3))
 conn.commit()
 
+# =====================
+# Защита от повторной обработки обновлений
+# =====================
+# Telegram может прислать обновление повторно (перезапуск без skip_pending, вебхуки).
+# Храним окно последних UPDATE_WINDOW_SIZE id: бит i маски = обновление (high - i) обработано.
+# Id ниже окна считается уже обработанным. После недели без обновлений Telegram
+# начинает нумерацию со случайного числа — на этот случай окно сбрасывается
+# по возрасту последнего checkpoint (UPDATE_WINDOW_MAX_AGE).
+UPDATE_WINDOW_SIZE = 4096
+UPDATE_WINDOW_MAX_AGE = 7 * 24 * 3600
+
+processed_high: Optional[int] = None
+processed_mask = 0
+processed_checkpoint_at: Optional[float] = None
+updates_lock = Lock()
+
+def reset_processed_updates():
+    global processed_high, processed_mask
+    processed_high = None
+    processed_mask = 0
+
+def load_processed_updates():
+    global processed_high, processed_mask, processed_checkpoint_at
+    row = conn.execute("SELECT high, bitmap, checkpointed_at FROM processed_updates WHERE id=1").fetchone()
+    if row:
+        processed_high = row[0]
+        processed_mask = int.from_bytes(row[1], "little")
+        processed_checkpoint_at = row[2]
+
+def claim_update(update_id: int) -> bool:
+    """Отмечает обновление как обработанное. False — если оно уже было."""
+    global processed_high, processed_mask
+    if processed_high is None or update_id > processed_high:
+        shift = update_id - processed_high if processed_high is not None else UPDATE_WINDOW_SIZE
+        processed_mask = ((processed_mask << shift) | 1) & ((1 << UPDATE_WINDOW_SIZE) - 1) if shift < UPDATE_WINDOW_SIZE else 1
+        processed_high = update_id
+        return True
+    offset = processed_high - update_id
+    if offset >= UPDATE_WINDOW_SIZE or processed_mask & (1 << offset):
+        return False
+    processed_mask |= 1 << offset
+    return True
+
+def checkpoint_processed_updates():
+    global processed_checkpoint_at
+    processed_checkpoint_at = time.time()
+    conn.execute("INSERT OR REPLACE INTO processed_updates(id, high, bitmap, checkpointed_at) VALUES(1,?,?,?)",
+                 (processed_high, processed_mask.to_bytes(UPDATE_WINDOW_SIZE // 8, "little"), processed_checkpoint_at))
+    conn.commit()
+
+_dispatch_updates = bot.process_new_updates
+
+def process_new_updates_once(updates):
+    with updates_lock:
+        # Неделя без обновлений — Telegram мог начать нумерацию заново
+        if processed_checkpoint_at is not None and time.time() - processed_checkpoint_at > UPDATE_WINDOW_MAX_AGE:
+            reset_processed_updates()
+        fresh = [u for u in updates if claim_update(u.update_id)]
+        if fresh:
+            # Фиксируем до обработки: при сбое обновление потеряется, но не выполнится дважды
+            checkpoint_processed_updates()
+    if len(fresh) < len(updates):
+        print(f"Skipped {len(updates) - len(fresh)} already processed update(s)")
+        # Сдвигаем offset поллинга, иначе отброшенные обновления будут приходить снова
+        bot.last_update_id = max(bot.last_update_id, max(u.update_id for u in updates))
+    if fresh:
+        _dispatch_updates(fresh)
+
+bot.process_new_updates = process_new_updates_once
+load_processed_updates()
+
 # =====================
 # Состояния пользователей
 # =====================
@@ -102,47 +239,122 @@ user_states: Dict[int, Dict[str, Any]] = {}
 # =====================
 # Утилиты для работы с БД 
 # =====================
+# Записи идут через conn.execute(): у каждого вызова свой курсор, поэтому
+# rowcount/lastrowid не перетираются планировщиком и другими потоками.
+# Счётчики изменений таблиц (для ETag в REST API): растут при каждой записи ботом
+table_versions: Dict[str, int] = {"tickets": 0, "users": 0, "admin_chats": 0}
+table_versions_lock = Lock()
+
+def bump_table_version(table: str):
+    with table_versions_lock:
+        table_versions[table] += 1
+
 def is_admin(tg_id: int) -> bool:
-    cur.execute("SELECT level FROM admins WHERE tg_id=?", (tg_id,))
-    return cur.fetchone() is not None
+    return conn.execute("SELECT level FROM admins WHERE tg_id=?", (tg_id,)).fetchone() is not None
 
 def get_admin_username(tg_id: int) -> str:
-    cur.execute("SELECT username FROM users WHERE tg_id=?", (tg_id,))
-    row = cur.fetchone()
+    row = conn.execute("SELECT username FROM users WHERE tg_id=?", (tg_id,)).fetchone()
     return f"@{row[0]}" if row and row[0] else f"Admin ID {tg_id}"
 
-def get_admins() -> List[int]:
-    cur.execute("SELECT tg_id FROM admins")
-    return [r[0] for r in cur.fetchall()]
+def get_reachable_admins() -> List[int]:
+    # Админы, которые не заблокировали бота (админ без записи в users считается доступным)
+    rows = conn.execute("""SELECT a.tg_id FROM admins a
+                           LEFT JOIN users u ON u.tg_id = a.tg_id
+                           WHERE u.is_active IS NULL OR u.is_active = 1""").fetchall()
+    return [r[0] for r in rows]
 
 def register_user(tg_id: int, username: Optional[str]):
-    cur.execute("INSERT OR IGNORE INTO users(tg_id, username) VALUES(?,?)", (tg_id, username))
+    changed = conn.execute("INSERT OR IGNORE INTO users(tg_id, username) VALUES(?,?)", (tg_id, username)).rowcount
+    # Пользователь написал боту — значит, снова доступен
+    changed += conn.execute("UPDATE users SET is_active=1, last_failure_at=NULL WHERE tg_id=? AND is_active=0", (tg_id,)).rowcount
+    conn.commit()
+    if changed > 0:
+        bump_table_version("users")
+
+# =====================
+# Ошибки доставки
+# =====================
+# Ответы Telegram, после которых писать в чат бессмысленно до следующего сообщения от пользователя
+UNREACHABLE_DESCRIPTIONS = (
+    "bot was blocked by the user",
+    "user is deactivated",
+    "chat not found",
+    "bot can't initiate conversation",
+    "bot was kicked",
+)
+
+def classify_delivery_error(e: Exception) -> str:
+    """Возвращает 'blocked', 'rate_limited' или 'other' по коду ошибки Telegram."""
+    if not isinstance(e, telebot.apihelper.ApiTelegramException):
+        return "other"
+    if e.error_code == 403:
+        return "blocked"
+    if e.error_code == 400 and any(d in str(e.description).lower() for d in UNREACHABLE_DESCRIPTIONS):
+        return "blocked"
+    if e.error_code == 429:
+        return "rate_limited"
+    return "other"
+
+# Сколько раз пробуем отправить сообщение рассылки, если Telegram ответил 429
+BROADCAST_MAX_ATTEMPTS = 3
+
+def retry_after_seconds(e: Exception) -> float:
+    """Пауза из ответа 429 (parameters.retry_after), по умолчанию 1 секунда."""
+    result_json = getattr(e, "result_json", None) or {}
+    return float(result_json.get("parameters", {}).get("retry_after", 1))
+
+def mark_user_unreachable(tg_id: int):
+    conn.execute("UPDATE users SET is_active=0, last_failure_at=CURRENT_TIMESTAMP WHERE tg_id=?", (tg_id,))
     conn.commit()
+    bump_table_version("users")
+
+def handle_delivery_error(chat_id: int, e: Exception, context: str = "message") -> str:
+    kind = classify_delivery_error(e)
+    if kind == "blocked":
+        mark_user_unreachable(chat_id)
+        print(f"Chat {chat_id} is unreachable ({context}), marked inactive: {e}")
+    else:
+        print(f"Error sending {context} to {chat_id}: {e}")
+    return kind
 
 def assign_admin_chat(user_id: int, admin_id: int):
-    cur.execute("INSERT OR REPLACE INTO admin_chats(user_id, admin_id) VALUES(?,?)", (user_id, admin_id))
+    previous_admin_id = get_assigned_admin(user_id)
+    conn.execute("INSERT OR REPLACE INTO admin_chats(user_id, admin_id) VALUES(?,?)", (user_id, admin_id))
     conn.commit()
+    bump_table_version("admin_chats")
+    if previous_admin_id:
+        update_workload(previous_admin_id, chats=-1)
+    update_workload(admin_id, chats=1)
+    touch_chat(user_id)
 
 def get_assigned_admin(user_id: int) -> Optional[int]:
-    cur.execute("SELECT admin_id FROM admin_chats WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
+    row = conn.execute("SELECT admin_id FROM admin_chats WHERE user_id=?", (user_id,)).fetchone()
     return row[0] if row else None
 
 def remove_assigned_chat(user_id: int):
-    cur.execute("DELETE FROM admin_chats WHERE user_id=?", (user_id,))
+    previous_admin_id = get_assigned_admin(user_id)
+    removed = conn.execute("DELETE FROM admin_chats WHERE user_id=?", (user_id,)).rowcount
     conn.commit()
+    if removed > 0:
+        bump_table_version("admin_chats")
+    cancel_job("chat_idle", user_id)
+    if previous_admin_id:
+        update_workload(previous_admin_id, chats=-1)
 
 def create_ticket(user_id: int, username: str, category: str, nick: str, description: str, proofs: Optional[List]) -> Optional[int]:
     proofs_json = json.dumps(proofs or [])
     try:
-        cur.execute("""INSERT INTO tickets(user_id, username, category, nick, description, proofs, status)
-                        VALUES(?,?,?,?,?,?,'open')""",
-                    (user_id, username, category, nick, description, proofs_json))
+        ticket_cur = conn.execute("""INSERT INTO tickets(user_id, username, category, nick, description, proofs, status)
+                                     VALUES(?,?,?,?,?,?,'open')""",
+                                  (user_id, username, category, nick, description, proofs_json))
         conn.commit()
-        ticket_id = cur.lastrowid
+        ticket_id = ticket_cur.lastrowid
 
         if ticket_id is not None:
-            notify_admins(int(ticket_id), username, category, nick, description)
+            on_ticket_changed(int(ticket_id))
+            schedule_job("ticket_sla", int(ticket_id), TICKET_SLA_SECONDS)
+            if not (AUTO_ASSIGN and offer_ticket(int(ticket_id), username, category, nick, description)):
+                notify_admins(int(ticket_id), username, category, nick, description)
             return int(ticket_id)
 
     except sqlite3.Error as e:
@@ -151,70 +363,185 @@ def create_ticket(user_id: int, username: str, category: str, nick: str, descrip
 
     return None
 
-def notify_admins(ticket_id: int, username: str, category: str, nick: str, description: str):
-    message_text = (
+def format_ticket_notification(ticket_id: int, username: str, category: str, nick: str, description: str) -> str:
+    return (
         f"🆕 **НОВЫЙ ТИКЕТ** (ID: {ticket_id})\n"
         f"Игрок: @{username}\n"
         f"Категория: **{category}**\n"
         f"Ник: {nick if nick != '-' else '—'}\n"
         f"Описание: _{description[:100]}..._"
     )
-    for a in get_admins():
+
+def notify_admins(ticket_id: int, username: str, category: str, nick: str, description: str, exclude: Optional[List[int]] = None):
+    message_text = format_ticket_notification(ticket_id, username, category, nick, description)
+    for a in get_reachable_admins():
+        if exclude and a in exclude:
+            continue
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("👁️ Просмотреть и взять в работу", callback_data=f"view_ticket_{ticket_id}"))
         try:
-            bot.send_message(a, message_text, reply_markup=kb, parse_mode="Markdown")
+            sent = bot.send_message(a, message_text, reply_markup=kb, parse_mode="Markdown")
+            register_ticket_view(ticket_id, a, sent.message_id, "notify")
         except Exception as e:
-            print(f"Error notifying admin {a}: {e}")
+            handle_delivery_error(a, e, "ticket notification")
 
-def get_ticket(ticket_id: int) -> Optional[Dict]:
-    cur.execute("SELECT id,user_id,username,category,nick,description,proofs,status,admin_id FROM tickets WHERE id=?", (ticket_id,))
-    row = cur.fetchone()
-    if not row:
-        return None
+TICKET_COLUMNS = "id, user_id, username, category, nick, description, proofs, status, admin_id, created_at"
+
+def ticket_from_row(row) -> Dict:
+    # row — результат SELECT {TICKET_COLUMNS}
     return {
         "id": row[0], "user_id": row[1], "username": row[2], "category": row[3],
         "nick": row[4], "description": row[5], "proofs": json.loads(row[6]) if row[6] else [],
-        "status": row[7], "admin_id": row[8]
+        "status": row[7], "admin_id": row[8], "created_at": row[9]
     }
 
+def get_ticket(ticket_id: int) -> Optional[Dict]:
+    row = conn.execute(f"SELECT {TICKET_COLUMNS} FROM tickets WHERE id=?", (ticket_id,)).fetchone()
+    return ticket_from_row(row) if row else None
+
 def get_open_tickets() -> List:
-    cur.execute("SELECT id, user_id, category, status, admin_id, created_at FROM tickets WHERE status IN ('open', 'in_progress') ORDER BY created_at DESC")
-    return cur.fetchall()
+    return conn.execute("SELECT id, user_id, category, status, admin_id, created_at FROM tickets WHERE status IN ('open', 'in_progress') ORDER BY created_at DESC").fetchall()
 
 def take_ticket(ticket_id: int, admin_id: int) -> bool:
-    cur.execute("UPDATE tickets SET status='in_progress', admin_id=? WHERE id=? AND status='open'", (admin_id, ticket_id))
+    taken = conn.execute("UPDATE tickets SET status='in_progress', admin_id=? WHERE id=? AND status='open'", (admin_id, ticket_id)).rowcount > 0
     conn.commit()
-    return cur.rowcount > 0
+    if taken:
+        clear_ticket_escalation(ticket_id)
+        acknowledge_offer(ticket_id)
+        update_workload(admin_id, tickets=1)
+        on_ticket_changed(ticket_id)
+    return taken
 
 def close_ticket(ticket_id: int, admin_id: int):
-    cur.execute("UPDATE tickets SET status='closed', admin_id=? WHERE id=?", (admin_id, ticket_id))
+    previous = conn.execute("SELECT status, admin_id FROM tickets WHERE id=?", (ticket_id,)).fetchone()
+    conn.execute("UPDATE tickets SET status='closed', admin_id=? WHERE id=?", (admin_id, ticket_id))
     conn.commit()
+    clear_ticket_escalation(ticket_id)
+    acknowledge_offer(ticket_id)
+    if previous and previous[0] == 'in_progress' and previous[1]:
+        update_workload(previous[1], tickets=-1)
+    on_ticket_changed(ticket_id)
     ticket = get_ticket(ticket_id)
     if ticket and ticket["user_id"]:
         remove_assigned_chat(ticket["user_id"])
         try:
             bot.send_message(ticket["user_id"], f"✅ Ваш тикет ID **{ticket_id}** закрыт администратором.", parse_mode="Markdown")
-        except Exception:
-            pass
+        except Exception as e:
+            handle_delivery_error(ticket["user_id"], e, "ticket closed notice")
 
 def list_users() -> List:
     cur.execute("SELECT tg_id, username FROM users")
     return cur.fetchall()
 
+def list_active_users() -> List:
+    return conn.execute("SELECT tg_id, username FROM users WHERE is_active=1").fetchall()
+
+def count_inactive_users() -> int:
+    return conn.execute("SELECT COUNT(*) FROM users WHERE is_active=0").fetchone()[0]
+
 def add_admin(tg_id: int, level: int = 1):
-    cur.execute("INSERT OR REPLACE INTO admins(tg_id, level) VALUES(?,?)", (tg_id, level))
+    conn.execute("INSERT OR REPLACE INTO admins(tg_id, level) VALUES(?,?)", (tg_id, level))
     conn.commit()
+    update_workload(tg_id)
+
+# =====================
+# Автоматическое распределение тикетов
+# =====================
+# AUTO_ASSIGN=1: новый тикет получает только наименее загруженный админ.
+# Если он не взял тикет за ASSIGN_ACK_TIMEOUT секунд — тикет уходит всем.
+AUTO_ASSIGN = os.getenv("AUTO_ASSIGN", "0") == "1"
+ASSIGN_ACK_TIMEOUT = float(os.getenv("ASSIGN_ACK_TIMEOUT", "120"))
+
+# admin_id -> {"tickets": тикеты in_progress, "chats": активные admin_chats, "offers": ожидающие предложения}
+admin_workload: Dict[int, Dict[str, int]] = {}
+# ticket_id -> admin_id, которому предложен тикет (тайм-аут — задача "offer_ack" планировщика)
+pending_offers: Dict[int, int] = {}
+workload_lock = Lock()
+
+def build_workload_index():
+    with workload_lock:
+        admin_workload.clear()
+        for (admin_id,) in conn.execute("SELECT tg_id FROM admins").fetchall():
+            admin_workload[admin_id] = {"tickets": 0, "chats": 0, "offers": 0}
+        for admin_id, count in conn.execute("SELECT admin_id, COUNT(*) FROM tickets WHERE status='in_progress' AND admin_id IS NOT NULL GROUP BY admin_id").fetchall():
+            admin_workload.setdefault(admin_id, {"tickets": 0, "chats": 0, "offers": 0})["tickets"] = count
+        for admin_id, count in conn.execute("SELECT admin_id, COUNT(*) FROM admin_chats GROUP BY admin_id").fetchall():
+            admin_workload.setdefault(admin_id, {"tickets": 0, "chats": 0, "offers": 0})["chats"] = count
+
+def update_workload(admin_id: int, tickets: int = 0, chats: int = 0, offers: int = 0):
+    with workload_lock:
+        load = admin_workload.setdefault(admin_id, {"tickets": 0, "chats": 0, "offers": 0})
+        load["tickets"] = max(0, load["tickets"] + tickets)
+        load["chats"] = max(0, load["chats"] + chats)
+        load["offers"] = max(0, load["offers"] + offers)
+
+def pick_least_loaded_admin() -> Optional[int]:
+    candidates = get_reachable_admins()
+    if not candidates:
+        return None
+    with workload_lock:
+        def load_key(admin_id: int) -> Tuple[int, int, int]:
+            load = admin_workload.get(admin_id, {"tickets": 0, "chats": 0, "offers": 0})
+            return (load["tickets"] + load["chats"] + load["offers"], load["tickets"], admin_id)
+        return min(candidates, key=load_key)
+
+def offer_ticket(ticket_id: int, username: str, category: str, nick: str, description: str) -> bool:
+    admin_id = pick_least_loaded_admin()
+    if admin_id is None:
+        return False
+
+    message_text, kb = render_ticket_notification({
+        "id": ticket_id, "username": username, "category": category, "nick": nick,
+        "description": description, "status": "open", "admin_id": None
+    }, offered=True)
+    try:
+        sent = bot.send_message(admin_id, message_text, reply_markup=kb, parse_mode="Markdown")
+    except Exception as e:
+        handle_delivery_error(admin_id, e, "ticket offer")
+        return False
+    register_ticket_view(ticket_id, admin_id, sent.message_id, "offer")
+    conn.execute("UPDATE tickets SET offered_admin_id=? WHERE id=?", (admin_id, ticket_id))
+    conn.commit()
+
+    with workload_lock:
+        pending_offers[ticket_id] = admin_id
+    update_workload(admin_id, offers=1)
+    schedule_job("offer_ack", ticket_id, ASSIGN_ACK_TIMEOUT)
+    return True
+
+def acknowledge_offer(ticket_id: int) -> Optional[int]:
+    with workload_lock:
+        admin_id = pending_offers.pop(ticket_id, None)
+    if admin_id is None:
+        return None
+    conn.execute("UPDATE tickets SET offered_admin_id=NULL WHERE id=?", (ticket_id,))
+    conn.commit()
+    cancel_job("offer_ack", ticket_id)
+    update_workload(admin_id, offers=-1)
+    return admin_id
+
+def offer_timed_out(ticket_id: int):
+    admin_id = acknowledge_offer(ticket_id)
+    if admin_id is None:
+        return
+    ticket = get_ticket(ticket_id)
+    if ticket and ticket["status"] == "open":
+        print(f"Ticket {ticket_id} was not taken by admin {admin_id}, notifying everyone")
+        notify_admins(ticket_id, ticket["username"], ticket["category"], ticket["nick"], ticket["description"], exclude=[admin_id])
+
+build_workload_index()
 
 # =====================
 # Меню (ReplyKeyboardMarkup)
 # =====================
-def admin_menu() -> types.ReplyKeyboardMarkup:
+def admin_menu(user_id: Optional[int] = None) -> types.ReplyKeyboardMarkup:
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     # ДОБАВЛЕНИЕ: Кнопка "📢 Рассылка"
     kb.row(types.KeyboardButton("📄 Список тикетов"), types.KeyboardButton("📢 Рассылка"))
     kb.row(types.KeyboardButton("👥 Список пользователей"), types.KeyboardButton("➕ Добавить админа"))
     kb.row(types.KeyboardButton("❌ Завершить чат"), types.KeyboardButton("🚪 В меню игрока"))
+    if user_id == OWNER_ID:
+        kb.row(types.KeyboardButton("💾 Резервная копия"))
     return kb
 
 def main_menu(user_id: int) -> types.ReplyKeyboardMarkup:
@@ -234,19 +561,11 @@ def main_menu(user_id: int) -> types.ReplyKeyboardMarkup:
 # =====================
 # Функции Админ-панели
 # =====================
-def show_tickets_list(cid: int, message_id: Optional[int] = None):
+def render_tickets_list() -> Tuple[str, types.InlineKeyboardMarkup, Optional[str]]:
     tickets = get_open_tickets()
 
     if not tickets:
-        message = "✅ Открытых или взятых в работу тикетов нет."
-        if message_id:
-            try:
-                bot.edit_message_text(message, cid, message_id, reply_markup=types.InlineKeyboardMarkup()) 
-            except Exception:
-                bot.send_message(cid, message) 
-        else:
-            bot.send_message(cid, message)
-        return
+        return "✅ Открытых или взятых в работу тикетов нет.", types.InlineKeyboardMarkup(), None
 
     message_text = "📄 **Активные тикеты:**\n\n"
     kb = types.InlineKeyboardMarkup()
@@ -267,14 +586,58 @@ def show_tickets_list(cid: int, message_id: Optional[int] = None):
         )
 
     kb.add(types.InlineKeyboardButton("🔄 Обновить список", callback_data="tickets_list"))
+    return message_text, kb, "Markdown"
+
+def show_tickets_list(cid: int, message_id: Optional[int] = None):
+    message_text, kb, parse_mode = render_tickets_list()
+    send_kb = kb if kb.keyboard else None
 
     if message_id:
         try:
-            bot.edit_message_text(message_text, cid, message_id, reply_markup=kb, parse_mode="Markdown")
+            bot.edit_message_text(message_text, cid, message_id, reply_markup=kb, parse_mode=parse_mode)
         except Exception:
-            bot.send_message(cid, message_text, reply_markup=kb, parse_mode="Markdown")
+            message_id = bot.send_message(cid, message_text, reply_markup=send_kb, parse_mode=parse_mode).message_id
     else:
-        bot.send_message(cid, message_text, reply_markup=kb, parse_mode="Markdown")
+        message_id = bot.send_message(cid, message_text, reply_markup=send_kb, parse_mode=parse_mode).message_id
+
+    register_ticket_list_view(cid, message_id)
+
+def ticket_status_text(ticket: Dict) -> str:
+    return {
+        'open': '🟢 Открыт',
+        'in_progress': f'🟠 В работе (Админ: {get_admin_username(ticket["admin_id"])})',
+        'closed': '🔴 Закрыт'
+    }.get(ticket['status'], 'Неизвестен')
+
+def render_ticket_details(ticket: Dict, current_admin_id: int) -> Tuple[str, types.InlineKeyboardMarkup]:
+    message_text = (
+        f"📄 **Тикет ID: {ticket['id']}**\n"
+        f"Игрок: @{ticket['username']} ({ticket['user_id']})\n"
+        f"Категория: **{ticket['category']}**\n"
+        f"Ник в игре: {ticket['nick'] if ticket['nick'] != '-' else 'Не указан'}\n"
+        f"Статус: **{ticket_status_text(ticket)}**\n"
+        f"\n**Описание:**\n_{ticket['description']}_"
+    )
+
+    proofs = ticket['proofs']
+    if proofs:
+        message_text += f"\n\n📎 **Доказательства:** ({len(proofs)} шт.)"
+
+    return message_text, get_ticket_details_markup(ticket, current_admin_id)
+
+def render_ticket_notification(ticket: Dict, offered: bool = False) -> Tuple[str, Optional[types.InlineKeyboardMarkup]]:
+    message_text = format_ticket_notification(ticket['id'], ticket['username'], ticket['category'], ticket['nick'], ticket['description'])
+    if offered:
+        message_text = "📌 **Тикет назначен вам**\n" + message_text
+    if ticket['status'] != 'open':
+        message_text += f"\n\nСтатус: **{ticket_status_text(ticket)}**"
+    if ticket['status'] == 'closed':
+        return message_text, types.InlineKeyboardMarkup()
+    kb = types.InlineKeyboardMarkup()
+    if offered and ticket['status'] == 'open':
+        kb.add(types.InlineKeyboardButton("🔨 Взять в работу", callback_data=f"take_ticket_{ticket['id']}"))
+    kb.add(types.InlineKeyboardButton("👁️ Просмотреть и взять в работу", callback_data=f"view_ticket_{ticket['id']}"))
+    return message_text, kb
 
 def get_ticket_details_markup(ticket: Dict, current_admin_id: int) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup()
@@ -294,10 +657,533 @@ def get_ticket_details_markup(ticket: Dict, current_admin_id: int) -> types.Inli
     else:
          kb.add(types.InlineKeyboardButton("💬 Чат уже активен", callback_data=f"connect_{user_id_for_chat}")) 
 
+    kb.add(types.InlineKeyboardButton("📜 История", callback_data=f"history_{user_id_for_chat}_0"))
     kb.add(types.InlineKeyboardButton("🔙 Назад к списку", callback_data="tickets_list"))
     return kb
 
 
+# =====================
+# Живое обновление сообщений с тикетами
+# =====================
+# Правки сообщений копятся в течение окна и применяются пачкой:
+# каждое сообщение редактируется не чаще одного раза за окно.
+EDIT_DEBOUNCE_SECONDS = float(os.getenv("EDIT_DEBOUNCE_SECONDS", "2"))
+
+# ticket_id -> {(chat_id, message_id): "notify" | "offer" | "details"}
+ticket_views: Dict[int, Dict[Tuple[int, int], str]] = {}
+# Последнее сообщение со списком тикетов в каждом чате: chat_id -> message_id
+ticket_list_views: Dict[int, int] = {}
+# Версия списка, которую сейчас показывает сообщение: (chat_id, message_id) -> версия
+list_view_versions: Dict[Tuple[int, int], int] = {}
+tickets_version = 0
+
+# Отложенные правки: (chat_id, message_id) -> ("list", None) | (kind, ticket_id)
+pending_view_edits: Dict[Tuple[int, int], Tuple[str, Optional[int]]] = {}
+views_lock = Lock()
+
+def register_ticket_view(ticket_id: int, chat_id: int, message_id: int, kind: str):
+    with views_lock:
+        ticket_views.setdefault(ticket_id, {})[(chat_id, message_id)] = kind
+
+def register_ticket_list_view(chat_id: int, message_id: int):
+    key = (chat_id, message_id)
+    with views_lock:
+        old_id = ticket_list_views.get(chat_id)
+        if old_id is not None and old_id != message_id:
+            list_view_versions.pop((chat_id, old_id), None)
+            pending_view_edits.pop((chat_id, old_id), None)
+        ticket_list_views[chat_id] = message_id
+        list_view_versions[key] = tickets_version
+        # Сообщение только что отрисовано — отложенная правка ему не нужна
+        pending_view_edits.pop(key, None)
+        # Карточка тикета ("🔙 Назад к списку") стала списком — больше не обновляем её как карточку
+        for views in ticket_views.values():
+            views.pop(key, None)
+
+def is_list_view_current(chat_id: int, message_id: int) -> bool:
+    with views_lock:
+        return list_view_versions.get((chat_id, message_id)) == tickets_version
+
+def forget_message_view(chat_id: int, message_id: int):
+    key = (chat_id, message_id)
+    with views_lock:
+        if ticket_list_views.get(chat_id) == message_id:
+            del ticket_list_views[chat_id]
+        list_view_versions.pop(key, None)
+        pending_view_edits.pop(key, None)
+        for views in ticket_views.values():
+            views.pop(key, None)
+
+def on_ticket_changed(ticket_id: int):
+    global tickets_version
+    bump_table_version("tickets")
+    with views_lock:
+        tickets_version += 1
+        for chat_id, message_id in ticket_list_views.items():
+            pending_view_edits[(chat_id, message_id)] = ("list", None)
+        for key, kind in ticket_views.get(ticket_id, {}).items():
+            pending_view_edits[key] = (kind, ticket_id)
+        if pending_view_edits:
+            schedule_job_once("view_flush", None, EDIT_DEBOUNCE_SECONDS)
+
+def _apply_view_edit(chat_id: int, message_id: int, text: str, kb: Optional[types.InlineKeyboardMarkup], parse_mode: Optional[str]) -> str:
+    try:
+        bot.edit_message_text(text, chat_id, message_id, reply_markup=kb, parse_mode=parse_mode)
+        return "ok"
+    except Exception as e:
+        description = str(getattr(e, "description", e)).lower()
+        if "message is not modified" in description:
+            return "ok"
+        kind = classify_delivery_error(e)
+        if kind == "rate_limited":
+            return "retry"
+        if kind == "blocked":
+            handle_delivery_error(chat_id, e, "ticket view edit")
+        elif "message to edit not found" not in description and "can't be edited" not in description:
+            print(f"Error editing ticket view {chat_id}/{message_id}: {e}")
+        return "gone"
+
+def flush_view_edits(_=None):
+    with views_lock:
+        edits = dict(pending_view_edits)
+        pending_view_edits.clear()
+        version = tickets_version
+
+    list_render = None
+    tickets_cache: Dict[int, Optional[Dict]] = {}
+    retry: Dict[Tuple[int, int], Tuple[str, Optional[int]]] = {}
+
+    for (chat_id, message_id), (kind, ticket_id) in edits.items():
+        if kind == "list":
+            if list_render is None:
+                list_render = render_tickets_list()
+            text, kb, parse_mode = list_render
+        else:
+            if ticket_id not in tickets_cache:
+                tickets_cache[ticket_id] = get_ticket(ticket_id)
+            ticket = tickets_cache[ticket_id]
+            if not ticket:
+                forget_message_view(chat_id, message_id)
+                continue
+            if kind in ("notify", "offer"):
+                text, kb = render_ticket_notification(ticket, offered=(kind == "offer"))
+            else:
+                text, kb = render_ticket_details(ticket, chat_id)
+            parse_mode = "Markdown"
+
+        result = _apply_view_edit(chat_id, message_id, text, kb, parse_mode)
+        if result == "retry":
+            retry[(chat_id, message_id)] = (kind, ticket_id)
+        elif result == "gone":
+            forget_message_view(chat_id, message_id)
+        elif kind == "list":
+            with views_lock:
+                if ticket_list_views.get(chat_id) == message_id:
+                    list_view_versions[(chat_id, message_id)] = version
+
+    with views_lock:
+        # Закрытый тикет больше не меняется — его сообщения можно забыть
+        for ticket_id, ticket in tickets_cache.items():
+            if ticket and ticket["status"] == "closed":
+                ticket_views.pop(ticket_id, None)
+        for key, edit in retry.items():
+            pending_view_edits.setdefault(key, edit)
+        if pending_view_edits:
+            schedule_job_once("view_flush", None, EDIT_DEBOUNCE_SECONDS)
+
+
+# =====================
+# Журнал переписки админ/игрок
+# =====================
+# Сообщения копятся в памяти и пишутся пачкой через executemany —
+# пересылка в чате не делает commit() на каждое сообщение.
+# Старые записи сворачиваются в сжатые блоки chat_transcript_archive.
+TRANSCRIPT_FLUSH_SECONDS = float(os.getenv("TRANSCRIPT_FLUSH_SECONDS", "5"))
+TRANSCRIPT_BATCH_SIZE = 100
+TRANSCRIPT_ARCHIVE_AFTER_DAYS = int(os.getenv("TRANSCRIPT_ARCHIVE_AFTER_DAYS", "30"))
+TRANSCRIPT_COMPACT_INTERVAL = 24 * 3600
+# Воркер перезапускается примерно раз в сутки — первое сжатие делаем вскоре после старта
+TRANSCRIPT_COMPACT_STARTUP_DELAY = 300
+TRANSCRIPT_PAGE_SIZE = 15
+TRANSCRIPT_SNIPPET_LENGTH = 200
+# Лимит Telegram — 4096 символов; оставляем запас на заголовок и эмодзи (UTF-16)
+TRANSCRIPT_PAGE_MAX_CHARS = 3500
+
+transcript_buffer: List[Tuple] = []
+transcript_lock = Lock()
+
+def log_transcript(user_id: int, admin_id: int, direction: str, content_type: str, text: Optional[str], file_id: Optional[str] = None):
+    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with transcript_lock:
+        transcript_buffer.append((user_id, admin_id, direction, content_type, text, file_id, created_at))
+        full = len(transcript_buffer) >= TRANSCRIPT_BATCH_SIZE
+    if full:
+        schedule_job("transcript_flush", None, 0)
+    else:
+        schedule_job_once("transcript_flush", None, TRANSCRIPT_FLUSH_SECONDS)
+
+def flush_transcripts(_=None):
+    with transcript_lock:
+        if not transcript_buffer:
+            return
+        batch = transcript_buffer[:]
+        transcript_buffer.clear()
+        try:
+            conn.executemany("""INSERT INTO chat_transcripts(user_id, admin_id, direction, content_type, text, file_id, created_at)
+                                VALUES(?,?,?,?,?,?,?)""", batch)
+            conn.commit()
+        except sqlite3.Error as e:
+            # Откатываем частично вставленные строки, иначе чужой commit() запишет их повторно
+            conn.rollback()
+            print(f"DB Error flushing transcripts: {e}")
+            transcript_buffer[:0] = batch
+
+def compact_transcripts(_=None):
+    try:
+        flush_transcripts()
+        cutoff = f"-{TRANSCRIPT_ARCHIVE_AFTER_DAYS} days"
+        users = conn.execute("SELECT DISTINCT user_id FROM chat_transcripts WHERE created_at < datetime('now', ?)", (cutoff,)).fetchall()
+        for (user_id,) in users:
+            rows = conn.execute("""SELECT id, admin_id, direction, content_type, text, file_id, created_at FROM chat_transcripts
+                                   WHERE user_id=? AND created_at < datetime('now', ?) ORDER BY id""", (user_id, cutoff)).fetchall()
+            if not rows:
+                continue
+            data = zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"))
+            try:
+                conn.execute("INSERT INTO chat_transcript_archive(user_id, first_id, last_id, messages, data) VALUES(?,?,?,?,?)",
+                             (user_id, rows[0][0], rows[-1][0], len(rows), data))
+                conn.execute("DELETE FROM chat_transcripts WHERE user_id=? AND id BETWEEN ? AND ?", (user_id, rows[0][0], rows[-1][0]))
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                print(f"DB Error compacting transcript of {user_id}: {e}")
+    finally:
+        # Ошибка не должна останавливать сжатие до конца жизни процесса
+        schedule_job("transcript_compact", None, TRANSCRIPT_COMPACT_INTERVAL)
+
+def get_transcript_page(user_id: int, before_id: Optional[int], limit: int = TRANSCRIPT_PAGE_SIZE) -> Tuple[List[Tuple], Optional[int]]:
+    """Страница переписки от новых к старым (keyset по id). Возвращает строки и курсор следующей страницы."""
+    flush_transcripts()
+    before = before_id if before_id else 2**63 - 1
+    rows = conn.execute("""SELECT id, admin_id, direction, content_type, text, file_id, created_at FROM chat_transcripts
+                           WHERE user_id=? AND id < ? ORDER BY id DESC LIMIT ?""", (user_id, before, limit)).fetchall()
+    rows = [tuple(r) for r in rows]
+
+    # Не хватило живых записей — дочитываем из архивных блоков
+    if len(rows) < limit:
+        if rows:
+            before = rows[-1][0]
+        for (data,) in conn.execute("""SELECT data FROM chat_transcript_archive
+                                       WHERE user_id=? AND first_id < ? ORDER BY first_id DESC""", (user_id, before)).fetchall():
+            archived = [tuple(r) for r in json.loads(zlib.decompress(data).decode("utf-8")) if r[0] < before]
+            rows.extend(reversed(archived[-(limit - len(rows)):]))
+            if len(rows) >= limit:
+                break
+
+    next_cursor = rows[-1][0] if len(rows) == limit else None
+    return rows, next_cursor
+
+def render_transcript_page(user_id: int, before_id: Optional[int]) -> Tuple[str, types.InlineKeyboardMarkup]:
+    rows, next_cursor = get_transcript_page(user_id, before_id)
+    kb = types.InlineKeyboardMarkup()
+    if not rows:
+        return f"📜 История переписки с игроком ID <b>{user_id}</b> пуста.", kb
+
+    header = f"📜 <b>История переписки с игроком ID {user_id}</b>\n"
+    # Набираем строки от новых к старым, пока страница помещается в одно сообщение
+    lines: List[str] = []
+    total = len(header)
+    for index, (row_id, admin_id, direction, content_type, text, _, created_at) in enumerate(rows):
+        try:
+            time_str = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").strftime("%H:%M %d.%m")
+        except (TypeError, ValueError):
+            time_str = "—"
+        author = "👤 Игрок" if direction == "player" else f"🛠 {html.escape(get_admin_username(admin_id))}"
+        body = html.escape((text or "")[:TRANSCRIPT_SNIPPET_LENGTH]) if content_type == "text" else "🖼 [фото]"
+        line = f"<i>{time_str}</i> {author}: {body}"
+        if lines and total + len(line) + 1 > TRANSCRIPT_PAGE_MAX_CHARS:
+            # Не поместившиеся строки уйдут на следующую страницу
+            next_cursor = rows[index - 1][0]
+            break
+        lines.append(line)
+        total += len(line) + 1
+
+    lines.append(header)
+    lines.reverse()
+
+    if next_cursor:
+        kb.add(types.InlineKeyboardButton("⬅️ Раньше", callback_data=f"history_{user_id}_{next_cursor}"))
+    return "\n".join(lines), kb
+
+
+# =====================
+# Планировщик: напоминания и тайм-ауты
+# =====================
+# Один поток и куча таймеров (due, seq, kind, key). Перенос или отмена задачи
+# не трогают кучу: устаревшие записи отбрасываются при извлечении.
+TICKET_SLA_SECONDS = float(os.getenv("TICKET_SLA_SECONDS", "900"))
+CHAT_IDLE_TIMEOUT = float(os.getenv("CHAT_IDLE_TIMEOUT", "1800"))
+FLOW_IDLE_TIMEOUT = float(os.getenv("FLOW_IDLE_TIMEOUT", "900"))
+# Напоминаний о невзятом тикете не больше этого числа; пауза между ними удваивается
+TICKET_SLA_MAX_ESCALATIONS = int(os.getenv("TICKET_SLA_MAX_ESCALATIONS", "3"))
+
+scheduler_heap: List[Tuple[float, int, str, Any]] = []
+# (kind, key) -> seq актуальной записи в куче
+scheduled_jobs: Dict[Tuple[str, Any], int] = {}
+scheduler_cond = Condition()
+scheduler_seq = 0
+
+def schedule_job(kind: str, key: Any, delay: float):
+    global scheduler_seq
+    with scheduler_cond:
+        scheduler_seq += 1
+        heapq.heappush(scheduler_heap, (time.monotonic() + delay, scheduler_seq, kind, key))
+        scheduled_jobs[(kind, key)] = scheduler_seq
+        # Слишком много устаревших записей — пересобираем кучу
+        if len(scheduler_heap) > 2 * len(scheduled_jobs) + 64:
+            scheduler_heap[:] = [e for e in scheduler_heap if scheduled_jobs.get((e[2], e[3])) == e[1]]
+            heapq.heapify(scheduler_heap)
+        scheduler_cond.notify()
+
+def schedule_job_once(kind: str, key: Any, delay: float):
+    # Не переносит уже запланированную задачу (окно дебаунса не сдвигается)
+    with scheduler_cond:
+        if (kind, key) in scheduled_jobs:
+            return
+        schedule_job(kind, key, delay)
+
+def cancel_job(kind: str, key: Any):
+    with scheduler_cond:
+        scheduled_jobs.pop((kind, key), None)
+
+def _next_due_job() -> Tuple[str, Any]:
+    with scheduler_cond:
+        while True:
+            while scheduler_heap and scheduled_jobs.get((scheduler_heap[0][2], scheduler_heap[0][3])) != scheduler_heap[0][1]:
+                heapq.heappop(scheduler_heap)
+            if not scheduler_heap:
+                scheduler_cond.wait()
+                continue
+            delay = scheduler_heap[0][0] - time.monotonic()
+            if delay > 0:
+                scheduler_cond.wait(delay)
+                continue
+            _, _, kind, key = heapq.heappop(scheduler_heap)
+            del scheduled_jobs[(kind, key)]
+            return kind, key
+
+def scheduler_loop():
+    while True:
+        kind, key = _next_due_job()
+        try:
+            SCHEDULER_HANDLERS[kind](key)
+        except Exception as e:
+            print(f"Scheduler job {kind}({key}) failed: {e}")
+
+def touch_chat(user_id: int):
+    schedule_job("chat_idle", user_id, CHAT_IDLE_TIMEOUT)
+
+def touch_user_flow(user_id: int):
+    schedule_job("flow_idle", user_id, FLOW_IDLE_TIMEOUT)
+
+def seconds_since(timestamp: str) -> float:
+    # created_at хранится SQLite в UTC (CURRENT_TIMESTAMP)
+    try:
+        created = datetime.strptime(timestamp.split('.')[0], "%Y-%m-%d %H:%M:%S")
+    except (AttributeError, ValueError):
+        return 0.0
+    return (datetime.utcnow() - created).total_seconds()
+
+# ticket_id -> сколько напоминаний уже отправлено
+ticket_escalations: Dict[int, int] = {}
+
+def escalation_threshold(level: int) -> float:
+    # Напоминание level приходит через SLA, 3·SLA, 7·SLA... после создания тикета
+    return TICKET_SLA_SECONDS * (2 ** (level + 1) - 1)
+
+def clear_ticket_escalation(ticket_id: int):
+    cancel_job("ticket_sla", ticket_id)
+    ticket_escalations.pop(ticket_id, None)
+
+def escalate_stale_ticket(ticket_id: int):
+    row = conn.execute("SELECT status, category, created_at FROM tickets WHERE id=?", (ticket_id,)).fetchone()
+    if not row or row[0] != 'open':
+        ticket_escalations.pop(ticket_id, None)
+        return
+    _, category, created_at = row
+    minutes = int(seconds_since(created_at) // 60)
+    level = ticket_escalations.get(ticket_id, 0)
+
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("👁️ Просмотреть и взять в работу", callback_data=f"view_ticket_{ticket_id}"))
+    for a in get_reachable_admins():
+        try:
+            bot.send_message(a, f"⏰ Тикет ID **{ticket_id}** ({category}) никто не взял уже **{minutes} мин.** "
+                                f"(напоминание {level + 1}/{TICKET_SLA_MAX_ESCALATIONS})", reply_markup=kb, parse_mode="Markdown")
+        except Exception as e:
+            handle_delivery_error(a, e, "ticket escalation")
+
+    # Повторяем с удвоенной паузой, но не больше TICKET_SLA_MAX_ESCALATIONS раз
+    level += 1
+    if level < TICKET_SLA_MAX_ESCALATIONS:
+        ticket_escalations[ticket_id] = level
+        schedule_job("ticket_sla", ticket_id, escalation_threshold(level) - escalation_threshold(level - 1))
+    else:
+        ticket_escalations.pop(ticket_id, None)
+
+def expire_idle_chat(user_id: int):
+    admin_id = get_assigned_admin(user_id)
+    if not admin_id:
+        return
+    remove_assigned_chat(user_id)
+    try:
+        bot.send_message(user_id, "⌛ Чат с администратором завершён из-за неактивности.", reply_markup=main_menu(user_id))
+    except Exception as e:
+        handle_delivery_error(user_id, e, "chat timeout")
+    try:
+        bot.send_message(admin_id, f"⌛ Чат с игроком ID **{user_id}** завершён из-за неактивности.", parse_mode="Markdown", reply_markup=admin_menu(admin_id))
+    except Exception as e:
+        handle_delivery_error(admin_id, e, "chat timeout")
+
+def expire_user_flow(user_id: int):
+    if user_states.pop(user_id, None) is None:
+        return
+    try:
+        bot.send_message(user_id, "⌛ Время ожидания истекло, действие отменено.", reply_markup=main_menu(user_id))
+    except Exception as e:
+        handle_delivery_error(user_id, e, "flow timeout")
+
+def run_scheduled_backup(_=None):
+    # Копирование может занять время — не задерживаем остальные таймеры
+    Thread(target=create_backup, daemon=True).start()
+    schedule_job("backup", None, BACKUP_INTERVAL)
+
+SCHEDULER_HANDLERS = {
+    "transcript_flush": flush_transcripts,
+    "transcript_compact": compact_transcripts,
+    "ticket_sla": escalate_stale_ticket,
+    "chat_idle": expire_idle_chat,
+    "flow_idle": expire_user_flow,
+    "offer_ack": offer_timed_out,
+    "view_flush": flush_view_edits,
+    "backup": run_scheduled_backup,
+}
+
+def rebuild_scheduler_from_db():
+    # Таймеры живут в памяти — после перезапуска восстанавливаем их по БД
+    for ticket_id, created_at in conn.execute("SELECT id, created_at FROM tickets WHERE status='open'").fetchall():
+        # Напоминания, срок которых прошёл до перезапуска, считаем отправленными
+        age = seconds_since(created_at)
+        level = 0
+        while level < TICKET_SLA_MAX_ESCALATIONS and escalation_threshold(level) <= age:
+            level += 1
+        if level == 0:
+            schedule_job("ticket_sla", ticket_id, escalation_threshold(0) - age)
+        elif level < TICKET_SLA_MAX_ESCALATIONS:
+            ticket_escalations[ticket_id] = level
+            schedule_job("ticket_sla", ticket_id, escalation_threshold(level) - age)
+    # Предложения автоназначения: предложение делается при создании тикета
+    for ticket_id, admin_id, created_at in conn.execute(
+            "SELECT id, offered_admin_id, created_at FROM tickets WHERE status='open' AND offered_admin_id IS NOT NULL").fetchall():
+        with workload_lock:
+            pending_offers[ticket_id] = admin_id
+        update_workload(admin_id, offers=1)
+        schedule_job("offer_ack", ticket_id, max(0.0, ASSIGN_ACK_TIMEOUT - seconds_since(created_at)))
+    # Время последнего сообщения в чате не хранится — отсчитываем простой заново
+    for (user_id,) in conn.execute("SELECT user_id FROM admin_chats").fetchall():
+        touch_chat(user_id)
+
+def start_scheduler():
+    rebuild_scheduler_from_db()
+    if BACKUP_INTERVAL > 0:
+        schedule_job("backup", None, BACKUP_INTERVAL)
+    schedule_job("transcript_compact", None, TRANSCRIPT_COMPACT_STARTUP_DELAY)
+    Thread(target=scheduler_loop, daemon=True).start()
+
+
+# =====================
+# Резервные копии базы данных
+# =====================
+# Онлайн-бэкап SQLite: копируем по BACKUP_PAGES_PER_STEP страниц и после каждого шага
+# спим BACKUP_STEP_SLEEP секунд (progress-колбэк), чтобы commit() в обработчиках
+# успевал пройти между шагами. Параметр sleep у backup() срабатывает только при
+# BUSY/LOCKED, поэтому паузу делаем сами.
+# Источник — основное соединение: его записи попадают в копию без перезапуска бэкапа.
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", "21600"))
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_SLEEP = 0.05
+# Лимит Telegram Bot API на отправку документов
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+backup_lock = Lock()
+
+def backup_step_pause(status: int, remaining: int, total: int):
+    if remaining > 0:
+        time.sleep(BACKUP_STEP_SLEEP)
+
+def create_backup() -> Optional[str]:
+    """Создаёт сжатый снимок базы и возвращает путь к нему (None — если бэкап уже идёт или упал)."""
+    if not backup_lock.acquire(blocking=False):
+        return None
+    name = os.path.splitext(os.path.basename(DB_PATH))[0]
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    raw_path = os.path.join(BACKUP_DIR, f"{name}-{stamp}.db")
+    gz_path = raw_path + ".gz"
+    compressing = False
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        dest = sqlite3.connect(raw_path)
+        try:
+            conn.backup(dest, pages=BACKUP_PAGES_PER_STEP, progress=backup_step_pause, sleep=BACKUP_STEP_SLEEP)
+        finally:
+            dest.close()
+
+        compressing = True
+        with open(raw_path, "rb") as src, gzip.open(gz_path, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+        rotate_backups(name)
+        print(f">>> Резервная копия создана: {gz_path}")
+        return gz_path
+    except (sqlite3.Error, OSError) as e:
+        print(f"Backup failed: {e}")
+        # Недописанный архив не должен попасть в ротацию как целый снимок
+        if compressing and os.path.exists(gz_path):
+            os.remove(gz_path)
+        return None
+    finally:
+        # Несжатая копия нужна только на время сжатия
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+        backup_lock.release()
+
+def send_backup_to_owner(chat_id: int):
+    # Запускается в отдельном потоке, чтобы не занимать обработчики бота на время копирования
+    backup_path = create_backup()
+    if not backup_path:
+        bot.send_message(chat_id, "❌ Не удалось создать копию (возможно, бэкап уже выполняется).", reply_markup=admin_menu(chat_id))
+        return
+    if os.path.getsize(backup_path) > TELEGRAM_DOCUMENT_LIMIT:
+        bot.send_message(chat_id, f"⚠️ Копия сохранена на сервере (<code>{html.escape(backup_path)}</code>), но она больше 50 МБ и не может быть отправлена в Telegram.", reply_markup=admin_menu(chat_id))
+        return
+    try:
+        with open(backup_path, "rb") as f:
+            bot.send_document(chat_id, f, caption=f"💾 {os.path.basename(backup_path)}", reply_markup=admin_menu(chat_id))
+    except Exception as e:
+        print(f"Error sending backup {backup_path}: {e}")
+        bot.send_message(chat_id, f"❌ Копия сохранена на сервере (<code>{html.escape(backup_path)}</code>), но отправить её не удалось.", reply_markup=admin_menu(chat_id))
+
+def rotate_backups(name: str):
+    snapshots = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith(f"{name}-") and f.endswith(".db.gz"))
+    for old in snapshots[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        try:
+            os.remove(os.path.join(BACKUP_DIR, old))
+        except OSError as e:
+            print(f"Error removing old backup {old}: {e}")
+
+
 # =====================
 # ВЕБ-СЕРВЕР ДЛЯ ПОДДЕРЖАНИЯ АКТИВНОСТИ (24/7)
 # =====================
@@ -307,6 +1193,137 @@ app = Flask('')
 def home():
     return "Bot is running!"
 
+# =====================
+# REST API (только чтение)
+# =====================
+# Доступ по токену API_TOKEN (заголовок "Authorization: Bearer <token>").
+# ETag строится из счётчика изменений таблицы, поэтому опрос без изменений
+# получает 304 без единого запроса к базе.
+API_TOKEN = os.getenv("API_TOKEN")
+API_DEFAULT_LIMIT = 50
+API_MAX_LIMIT = 200
+TICKET_STATUSES = ("open", "in_progress", "closed")
+
+# Счётчики живут в памяти — метка запуска не даёт ETag совпасть после перезапуска
+API_BOOT_ID = f"{int(time.time()):x}"
+
+def api_db() -> sqlite3.Connection:
+    # Read-only соединение на время одного запроса (открывается только если нет 304)
+    if "api_conn" not in g:
+        g.api_conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    return g.api_conn
+
+@app.teardown_request
+def api_close_db(_exc):
+    db = g.pop("api_conn", None)
+    if db is not None:
+        db.close()
+
+def api_error(status: int, message: str) -> Response:
+    response = jsonify({"error": message})
+    response.status_code = status
+    return response
+
+@app.before_request
+def api_auth():
+    if not request.path.startswith("/api/"):
+        return None
+    if not API_TOKEN:
+        return api_error(404, "API disabled")
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:] if auth.startswith("Bearer ") else ""
+    if not hmac.compare_digest(token, API_TOKEN):
+        return api_error(401, "invalid token")
+    return None
+
+def api_page_params() -> Tuple[Optional[int], int]:
+    cursor = request.args.get("cursor")
+    limit = request.args.get("limit", str(API_DEFAULT_LIMIT))
+    try:
+        return (int(cursor) if cursor else None), max(1, min(API_MAX_LIMIT, int(limit)))
+    except ValueError:
+        raise ValueError("cursor and limit must be integers")
+
+def api_cached(table: str, compute, *key_parts) -> Response:
+    """Отдаёт 304, если у клиента актуальная версия, иначе выполняет запрос."""
+    with table_versions_lock:
+        version = table_versions[table]
+    etag = '"' + "-".join([API_BOOT_ID, table, str(version)] + [str(p) for p in key_parts]) + '"'
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers={"ETag": etag})
+    payload = compute()
+    if payload is None:
+        return api_error(404, "not found")
+    response = jsonify(payload)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route('/api/tickets')
+def api_tickets():
+    try:
+        cursor, limit = api_page_params()
+    except ValueError as e:
+        return api_error(400, str(e))
+    status = request.args.get("status")
+    if status and status not in TICKET_STATUSES:
+        return api_error(400, f"status must be one of {', '.join(TICKET_STATUSES)}")
+
+    def compute():
+        # Keyset-пагинация от новых к старым: следующая страница — id < cursor
+        sql = f"SELECT {TICKET_COLUMNS} FROM tickets WHERE id < ?"
+        params: List[Any] = [cursor if cursor is not None else 2**63 - 1]
+        if status:
+            sql += " AND status = ?"
+            params.append(status)
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        rows = api_db().execute(sql, params).fetchall()
+        items = [ticket_from_row(r) for r in rows]
+        return {"items": items, "next_cursor": items[-1]["id"] if len(items) == limit else None}
+
+    return api_cached("tickets", compute, status or "all", cursor, limit)
+
+@app.route('/api/tickets/<int:ticket_id>')
+def api_ticket(ticket_id: int):
+    def compute():
+        row = api_db().execute(f"SELECT {TICKET_COLUMNS} FROM tickets WHERE id=?", (ticket_id,)).fetchone()
+        return ticket_from_row(row) if row else None
+
+    return api_cached("tickets", compute, "id", ticket_id)
+
+@app.route('/api/users')
+def api_users():
+    try:
+        cursor, limit = api_page_params()
+    except ValueError as e:
+        return api_error(400, str(e))
+
+    def compute():
+        rows = api_db().execute(
+            "SELECT tg_id, username, is_active, last_failure_at FROM users WHERE tg_id > ? ORDER BY tg_id LIMIT ?",
+            (cursor if cursor is not None else -2**63, limit)).fetchall()
+        items = [{"tg_id": r[0], "username": r[1], "is_active": bool(r[2]), "last_failure_at": r[3]} for r in rows]
+        return {"items": items, "next_cursor": items[-1]["tg_id"] if len(items) == limit else None}
+
+    return api_cached("users", compute, cursor, limit)
+
+@app.route('/api/chats')
+def api_chats():
+    try:
+        cursor, limit = api_page_params()
+    except ValueError as e:
+        return api_error(400, str(e))
+
+    def compute():
+        rows = api_db().execute(
+            "SELECT user_id, admin_id FROM admin_chats WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (cursor if cursor is not None else -2**63, limit)).fetchall()
+        items = [{"user_id": r[0], "admin_id": r[1]} for r in rows]
+        return {"items": items, "next_cursor": items[-1]["user_id"] if len(items) == limit else None}
+
+    return api_cached("admin_chats", compute, cursor, limit)
+
 def run_flask_server():
     app.run(host='0.0.0.0', port=8080) 
 
@@ -331,6 +1348,7 @@ def message_handler(msg):
     username: str = username_raw if username_raw else f"user_{cid}" 
 
     register_user(cid, username_raw)
+    touch_user_flow(cid)
 
     # ------------------
     # 1. ОБРАБОТКА СОСТОЯНИЙ
@@ -346,19 +1364,19 @@ def message_handler(msg):
         # 1.1. Администратор: Ввод ID для добавления
         if step == "waiting_for_admin_id" and is_admin(cid):
             if not text:
-                bot.send_message(cid, "❌ Ожидался ввод Telegram ID.", reply_markup=admin_menu())
+                bot.send_message(cid, "❌ Ожидался ввод Telegram ID.", reply_markup=admin_menu(cid))
                 user_states.pop(cid)
                 return
             try:
                 new_admin_id = int(text.strip())
                 add_admin(new_admin_id)
-                bot.send_message(cid, f"✅ Пользователь с ID **{new_admin_id}** теперь администратор (уровень 1).", parse_mode="Markdown", reply_markup=admin_menu())
+                bot.send_message(cid, f"✅ Пользователь с ID **{new_admin_id}** теперь администратор (уровень 1).", parse_mode="Markdown", reply_markup=admin_menu(cid))
                 try:
                     bot.send_message(new_admin_id, "🥳 Поздравляем! Вы получили права администратора на **SKEZZY ONLINE**.", reply_markup=main_menu(new_admin_id))
                 except Exception:
                     pass 
             except ValueError:
-                bot.send_message(cid, "❌ Некорректный ID. Введите числовой Telegram ID пользователя.", parse_mode="Markdown", reply_markup=admin_menu()) 
+                bot.send_message(cid, "❌ Некорректный ID. Введите числовой Telegram ID пользователя.", parse_mode="Markdown", reply_markup=admin_menu(cid)) 
             finally:
                 user_states.pop(cid)
             return
@@ -367,7 +1385,7 @@ def message_handler(msg):
         if step == "waiting_for_ticket_response":
 
             if text == "Отмена":
-                bot.send_message(cid, "❌ Ответ на тикет отменен.", reply_markup=admin_menu())
+                bot.send_message(cid, "❌ Ответ на тикет отменен.", reply_markup=admin_menu(cid))
                 user_states.pop(cid)
                 return
 
@@ -386,10 +1404,11 @@ def message_handler(msg):
 
             try:
                 bot.send_message(user_id, response_text, parse_mode="Markdown")
-                bot.send_message(cid, f"✅ Ответ по тикету ID **{ticket_id}** успешно отправлен игроку.", parse_mode="Markdown", reply_markup=admin_menu())
+                log_transcript(user_id, cid, "admin", "text", text)
+                bot.send_message(cid, f"✅ Ответ по тикету ID **{ticket_id}** успешно отправлен игроку.", parse_mode="Markdown", reply_markup=admin_menu(cid))
             except Exception as e:
                 print(f"Error sending reply to user {user_id}: {e}")
-                bot.send_message(cid, f"❌ Ошибка отправки: не удалось отправить ответ игроку ID **{user_id}**.", parse_mode="Markdown", reply_markup=admin_menu())
+                bot.send_message(cid, f"❌ Ошибка отправки: не удалось отправить ответ игроку ID **{user_id}**.", parse_mode="Markdown", reply_markup=admin_menu(cid))
 
             user_states.pop(cid)
             return
@@ -397,12 +1416,14 @@ def message_handler(msg):
         # 1.3. Администратор: Ожидание поста для рассылки
         if step == "waiting_for_broadcast_message" and is_admin(cid):
             if text == "Отмена":
-                bot.send_message(cid, "❌ Рассылка отменена.", reply_markup=admin_menu())
+                bot.send_message(cid, "❌ Рассылка отменена.", reply_markup=admin_menu(cid))
                 user_states.pop(cid)
                 return
 
-            all_users = list_users()
+            all_users = list_active_users()
             sent_count = 0
+            blocked_count = 0
+            failed_count = 0
 
             # Отправка рассылки
             for user_id, _ in all_users:
@@ -410,24 +1431,38 @@ def message_handler(msg):
                 if user_id == cid:
                     continue
 
-                try:
-                    if msg.content_type == 'text':
-                        bot.send_message(user_id, text, parse_mode="Markdown")
-                    elif msg.content_type == 'photo':
-                        # Отправляем фото с подписью (текстом сообщения, если есть)
-                        caption = msg.caption if msg.caption else ""
-                        bot.send_photo(user_id, msg.photo[-1].file_id, caption=caption, parse_mode="Markdown")
-                    sent_count += 1
-                except Exception as e:
-                    # Обработка ошибки, например, если пользователь заблокировал бота
-                    print(f"Error sending broadcast to user {user_id}: {e}")
+                for attempt in range(BROADCAST_MAX_ATTEMPTS):
+                    try:
+                        if msg.content_type == 'text':
+                            bot.send_message(user_id, text, parse_mode="Markdown")
+                        elif msg.content_type == 'photo':
+                            # Отправляем фото с подписью (текстом сообщения, если есть)
+                            caption = msg.caption if msg.caption else ""
+                            bot.send_photo(user_id, msg.photo[-1].file_id, caption=caption, parse_mode="Markdown")
+                        sent_count += 1
+                        break
+                    except Exception as e:
+                        kind = handle_delivery_error(user_id, e, "broadcast")
+                        # Упёрлись в лимит Telegram — ждём сколько просят и повторяем
+                        if kind == "rate_limited" and attempt + 1 < BROADCAST_MAX_ATTEMPTS:
+                            time.sleep(retry_after_seconds(e))
+                            continue
+                        # Пользователь заблокировал бота или удалил аккаунт — больше не пишем ему
+                        if kind == "blocked":
+                            blocked_count += 1
+                        else:
+                            failed_count += 1
+                        break
 
             bot.send_message(
                 cid, 
                 f"✅ **Рассылка завершена!**\n\n"
-                f"Отправлено сообщений: **{sent_count}**",
+                f"Отправлено сообщений: **{sent_count}**\n"
+                f"Недоступно (заблокировали бота): **{blocked_count}**\n"
+                f"Ошибки отправки: **{failed_count}**\n"
+                f"Пропущено ранее недоступных: **{count_inactive_users() - blocked_count}**",
                 parse_mode="Markdown",
-                reply_markup=admin_menu()
+                reply_markup=admin_menu(cid)
             )
             user_states.pop(cid)
             return
@@ -552,19 +1587,19 @@ def message_handler(msg):
         if get_assigned_admin(cid):
             bot.send_message(cid,"❗ Вы уже подключены к администратору.", reply_markup=main_menu(cid))
             return
-        for a in get_admins():
+        for a in get_reachable_admins():
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("🔗 Подключиться", callback_data=f"connect_{cid}"))
             try:
                 bot.send_message(a,f"🆘 Игрок @{username} ({cid}) вызвал админа.", reply_markup=kb)
-            except Exception:
-                pass
+            except Exception as e:
+                handle_delivery_error(a, e, "admin call")
         bot.send_message(cid,"🆘 Ваш вызов отправлен администраторам. Ожидайте подключения.", reply_markup=main_menu(cid))
         return
 
     # --- КНОПКИ АДМИН-ПАНЕЛИ (ReplyKeyboardMarkup) ---
     if text == "🛠 Админ-панель" and is_admin(cid):
-        bot.send_message(cid,"🛠 Добро пожаловать в Админ-панель. Выберите действие:", reply_markup=admin_menu())
+        bot.send_message(cid,"🛠 Добро пожаловать в Админ-панель. Выберите действие:", reply_markup=admin_menu(cid))
         return
 
     if text == "🚪 В меню игрока" and is_admin(cid):
@@ -595,12 +1630,17 @@ def message_handler(msg):
         message_text = "👥 **Список пользователей:**\n"
         for tg_id, username_user in users: 
             message_text += f"ID: `{tg_id}` | @{username_user if username_user else 'Нет юзернейма'}\n"
-        bot.send_message(cid, message_text, parse_mode="Markdown", reply_markup=admin_menu())
+        bot.send_message(cid, message_text, parse_mode="Markdown", reply_markup=admin_menu(cid))
+        return
+
+    if text == "💾 Резервная копия" and cid == OWNER_ID:
+        bot.send_message(cid, "💾 Создаю резервную копию базы...", reply_markup=admin_menu(cid))
+        Thread(target=send_backup_to_owner, args=(cid,), daemon=True).start()
         return
 
     if text == "➕ Добавить админа" and is_admin(cid):
         user_states[cid] = {"step": "waiting_for_admin_id"}
-        bot.send_message(cid, "➕ **Добавление администратора**.\nВведите **Telegram ID** пользователя, которого хотите назначить администратором:", parse_mode="Markdown", reply_markup=admin_menu())
+        bot.send_message(cid, "➕ **Добавление администратора**.\nВведите **Telegram ID** пользователя, которого хотите назначить администратором:", parse_mode="Markdown", reply_markup=admin_menu(cid))
         return
 
     if text == "❌ Завершить чат":
@@ -615,13 +1655,13 @@ def message_handler(msg):
                 remove_assigned_chat(uid)
                 removed_chats += 1
             if removed_chats > 0:
-                bot.send_message(cid, f"❌ Вы завершили {removed_chats} активных чатов.", reply_markup=admin_menu())
+                bot.send_message(cid, f"❌ Вы завершили {removed_chats} активных чатов.", reply_markup=admin_menu(cid))
             else:
-                bot.send_message(cid, "❌ Активных чатов для завершения не найдено.", reply_markup=admin_menu())
+                bot.send_message(cid, "❌ Активных чатов для завершения не найдено.", reply_markup=admin_menu(cid))
         else:
             if admin_id:
                 try:
-                    bot.send_message(admin_id,f"❌ Игрок @{username} завершил чат.", reply_markup=admin_menu())
+                    bot.send_message(admin_id,f"❌ Игрок @{username} завершил чат.", reply_markup=admin_menu(admin_id))
                 except Exception:
                     pass
                 remove_assigned_chat(cid)
@@ -635,23 +1675,48 @@ def message_handler(msg):
 
         admin_id_assigned = get_assigned_admin(cid)
         if admin_id_assigned:
-            if msg.content_type == 'text':
-                bot.send_message(admin_id_assigned, f"💬 Игрок @{username}: {text}")
-            else:
-                bot.send_message(admin_id_assigned, f"💬 Игрок @{username} отправил фото:")
-                bot.forward_message(admin_id_assigned, cid, msg.message_id)
+            touch_chat(cid)
+            try:
+                if msg.content_type == 'text':
+                    bot.send_message(admin_id_assigned, f"💬 Игрок @{username}: {text}")
+                else:
+                    bot.send_message(admin_id_assigned, f"💬 Игрок @{username} отправил фото:")
+                    bot.forward_message(admin_id_assigned, cid, msg.message_id)
+                # В журнал попадают только доставленные сообщения (как и быстрые ответы)
+                log_transcript(cid, admin_id_assigned, "player", msg.content_type, text or msg.caption,
+                               msg.photo[-1].file_id if msg.content_type == 'photo' else None)
+            except Exception as e:
+                handle_delivery_error(admin_id_assigned, e, "relay")
             return
 
         if is_admin(cid):
-            cur.execute("SELECT user_id FROM admin_chats WHERE admin_id=?", (cid,))
+            # Пишем только тем игрокам из чатов админа, которые не заблокировали бота
+            cur.execute("""SELECT c.user_id, COALESCE(u.is_active, 1) FROM admin_chats c
+                           LEFT JOIN users u ON u.tg_id = c.user_id
+                           WHERE c.admin_id=?""", (cid,))
             rows = cur.fetchall()
-            for row in rows:
-                user_id = row[0]
-                if msg.content_type == 'text':
-                    bot.send_message(user_id, f"💬 Админ: {text}")
-                else:
-                    bot.send_message(user_id, "💬 Админ отправил фото:")
-                    bot.forward_message(user_id, cid, msg.message_id)
+            unreachable = []
+            for user_id, is_active in rows:
+                if is_active:
+                    touch_chat(user_id)
+                    try:
+                        if msg.content_type == 'text':
+                            bot.send_message(user_id, f"💬 Админ: {text}")
+                        else:
+                            bot.send_message(user_id, "💬 Админ отправил фото:")
+                            bot.forward_message(user_id, cid, msg.message_id)
+                        log_transcript(user_id, cid, "admin", msg.content_type, text or msg.caption,
+                                       msg.photo[-1].file_id if msg.content_type == 'photo' else None)
+                        continue
+                    except Exception as e:
+                        if handle_delivery_error(user_id, e, "relay") != "blocked":
+                            continue
+                # Игрок заблокировал бота — чат с ним бесполезен, закрываем его
+                remove_assigned_chat(user_id)
+                unreachable.append(user_id)
+            if unreachable:
+                ids = ", ".join(str(uid) for uid in unreachable)
+                bot.send_message(cid, f"⚠️ Игрок(и) ID {ids} недоступны (заблокировали бота). Чат с ними завершён.", reply_markup=admin_menu(cid))
             if rows:
                 return
 
@@ -669,6 +1734,7 @@ def callback_handler(call):
     data = call.data
     cid = call.from_user.id
     bot.answer_callback_query(call.id)
+    touch_user_flow(cid)
 
     if not is_admin(cid):
         bot.send_message(cid, "⛔ У вас нет прав для этого действия.", reply_markup=main_menu(cid))
@@ -687,7 +1753,7 @@ def callback_handler(call):
             if current_admin_id == cid:
                 bot.send_message(cid, f"Вы уже подключены к чату с пользователем ID **{uid}**. Начните писать сообщение.", parse_mode="Markdown", reply_markup=kb_chat)
             else:
-                bot.send_message(cid, f"❌ Чат уже занят другим администратором ({get_admin_username(current_admin_id)}).", parse_mode="Markdown", reply_markup=admin_menu())
+                bot.send_message(cid, f"❌ Чат уже занят другим администратором ({get_admin_username(current_admin_id)}).", parse_mode="Markdown", reply_markup=admin_menu(cid))
             return
 
         assign_admin_chat(uid, cid)
@@ -697,11 +1763,14 @@ def callback_handler(call):
         try:
              bot.send_message(uid,"🆘 Админ подключился к чату. Теперь можно писать сообщения.", reply_markup=kb_chat)
         except Exception:
-             bot.send_message(cid, f"❌ Не удалось уведомить пользователя ID {uid} о подключении.", reply_markup=admin_menu())
+             bot.send_message(cid, f"❌ Не удалось уведомить пользователя ID {uid} о подключении.", reply_markup=admin_menu(cid))
         return
 
     # 2. Обновление списка тикетов
     if data == "tickets_list":
+        # Список и так обновляется автоматически — повторный запрос не нужен
+        if is_list_view_current(cid, call.message.message_id):
+            return
         show_tickets_list(cid, call.message.message_id) 
         return
 
@@ -711,7 +1780,7 @@ def callback_handler(call):
         ticket = get_ticket(ticket_id)
 
         if not ticket:
-             bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** не найден.", parse_mode="Markdown", reply_markup=admin_menu())
+             bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** не найден.", parse_mode="Markdown", reply_markup=admin_menu(cid))
              return
 
         user_states[cid] = {
@@ -741,34 +1810,20 @@ def callback_handler(call):
         ticket = get_ticket(ticket_id)
 
         if not ticket:
-            bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** не найден.", parse_mode="Markdown", reply_markup=admin_menu())
+            bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** не найден.", parse_mode="Markdown", reply_markup=admin_menu(cid))
             return
 
-        status_text = {
-            'open': '🟢 Открыт',
-            'in_progress': f'🟠 В работе (Админ: {get_admin_username(ticket["admin_id"])})',
-            'closed': '🔴 Закрыт'
-        }.get(ticket['status'], 'Неизвестен')
-
-        message_text = (
-            f"📄 **Тикет ID: {ticket['id']}**\n"
-            f"Игрок: @{ticket['username']} ({ticket['user_id']})\n"
-            f"Категория: **{ticket['category']}**\n"
-            f"Ник в игре: {ticket['nick'] if ticket['nick'] != '-' else 'Не указан'}\n"
-            f"Статус: **{status_text}**\n"
-            f"\n**Описание:**\n_{ticket['description']}_"
-        )
-
+        message_text, kb = render_ticket_details(ticket, cid)
         proofs = ticket['proofs']
-        if proofs:
-             message_text += f"\n\n📎 **Доказательства:** ({len(proofs)} шт.)"
-
-        kb = get_ticket_details_markup(ticket, cid)
 
+        # Сообщение (список или уведомление) превращается в карточку тикета
+        forget_message_view(cid, call.message.message_id)
         try:
             bot.edit_message_text(message_text, cid, call.message.message_id, reply_markup=kb, parse_mode="Markdown")
+            details_message_id = call.message.message_id
         except Exception:
-            bot.send_message(cid, message_text, reply_markup=kb, parse_mode="Markdown")
+            details_message_id = bot.send_message(cid, message_text, reply_markup=kb, parse_mode="Markdown").message_id
+        register_ticket_view(ticket_id, cid, details_message_id, "details")
 
         if proofs:
             for file_id in proofs:
@@ -784,21 +1839,25 @@ def callback_handler(call):
     if data.startswith("take_ticket_"):
         ticket_id = int(data.split("_")[2])
         if take_ticket(ticket_id, cid):
-            bot.send_message(cid, f"✅ Вы взяли тикет ID **{ticket_id}** в работу. Можете начать чат с игроком или ответить.", parse_mode="Markdown", reply_markup=admin_menu())
+            bot.send_message(cid, f"✅ Вы взяли тикет ID **{ticket_id}** в работу. Можете начать чат с игроком или ответить.", parse_mode="Markdown", reply_markup=admin_menu(cid))
             ticket = get_ticket(ticket_id)
             if ticket:
-                kb = get_ticket_details_markup(ticket, cid)
+                # Уведомление/предложение превращается в карточку тикета: дальше обновляем её как "details",
+                # иначе отложенная правка вернёт кнопки уведомления
+                message_text, kb = render_ticket_details(ticket, cid)
+                forget_message_view(cid, call.message.message_id)
                 try:
-                    bot.edit_message_reply_markup(cid, call.message.message_id, reply_markup=kb)
+                    bot.edit_message_text(message_text, cid, call.message.message_id, reply_markup=kb, parse_mode="Markdown")
+                    register_ticket_view(ticket_id, cid, call.message.message_id, "details")
                 except Exception:
                     pass
         else:
             ticket = get_ticket(ticket_id)
             if ticket and ticket['admin_id']:
                 admin_name = get_admin_username(ticket['admin_id'])
-                bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** уже взят в работу администратором {admin_name}.", parse_mode="Markdown", reply_markup=admin_menu())
+                bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** уже взят в работу администратором {admin_name}.", parse_mode="Markdown", reply_markup=admin_menu(cid))
             else:
-                bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** уже не 'open'.", parse_mode="Markdown", reply_menu=admin_menu())
+                bot.send_message(cid, f"❌ Тикет ID **{ticket_id}** уже не 'open'.", parse_mode="Markdown", reply_markup=admin_menu(cid))
         return
 
     # 6. Обработка закрытия тикета прямо из списка
@@ -815,11 +1874,27 @@ def callback_handler(call):
     if data.startswith("close_ticket_"):
         ticket_id = int(data.split("_")[2])
         close_ticket(ticket_id, cid)
+        forget_message_view(cid, call.message.message_id)
 
         try:
              bot.edit_message_text(f"✅ Тикет ID **{ticket_id}** закрыт администратором.", cid, call.message.message_id, parse_mode="Markdown", reply_markup=types.InlineKeyboardMarkup())
         except Exception:
-             bot.send_message(cid, f"✅ Тикет ID **{ticket_id}** закрыт администратором.", parse_mode="Markdown", reply_markup=admin_menu())
+             bot.send_message(cid, f"✅ Тикет ID **{ticket_id}** закрыт администратором.", parse_mode="Markdown", reply_markup=admin_menu(cid))
+        return
+
+    # 8. История переписки с игроком (постранично, от новых к старым)
+    if data.startswith("history_"):
+        _, uid, before_id = data.split("_")
+        message_text, kb = render_transcript_page(int(uid), int(before_id) or None)
+
+        # Первая страница — новым сообщением, следующие — правкой этого же сообщения
+        if int(before_id):
+            try:
+                bot.edit_message_text(message_text, cid, call.message.message_id, reply_markup=kb, parse_mode="HTML")
+                return
+            except Exception:
+                pass
+        bot.send_message(cid, message_text, reply_markup=kb, parse_mode="HTML")
         return
 
 # =====================
@@ -830,7 +1905,11 @@ if __name__ == "__main__":
     t = Thread(target=run_flask_server)
     t.start()
 
-    # 2. Запуск Telegram-бота
+    # 2. Планировщик напоминаний и тайм-аутов
+    start_scheduler()
+
+    # 3. Запуск Telegram-бота
     print("Bot started...")
-    # !!! ИСПРАВЛЕННАЯ СТРОКА: Удалил clean_up_old_updates !!!
-    bot.infinity_polling(skip_pending=True)
\ No newline at end of file
+    # Обновления, накопившиеся за время перезапуска, не выбрасываем:
+    # повторы отсекает process_new_updates_once
+    bot.infinity_polling(skip_pending=False)
\ No newline at end of file